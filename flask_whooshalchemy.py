@@ -18,29 +18,142 @@ from __future__ import absolute_import
 import flask_sqlalchemy as flask_sqlalchemy
 
 import sqlalchemy
+from sqlalchemy.ext.hybrid import HYBRID_PROPERTY
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import Session
 
 from whoosh.qparser import OrGroup
 from whoosh.qparser import AndGroup
 from whoosh.qparser import MultifieldParser
 from whoosh.analysis import StemmingAnalyzer
+from whoosh.analysis import RegexTokenizer
+from whoosh.analysis import LowercaseFilter
+from whoosh.highlight import Highlighter
+from whoosh.highlight import PinpointFragmenter
+from whoosh.highlight import DEFAULT_CHARLIMIT
 import whoosh.index
 from whoosh.fields import Schema
+from whoosh.query import And
+from whoosh.query import Term
+from whoosh.query import NullQuery
+from whoosh.collectors import TimeLimitCollector
+from whoosh.searching import TimeLimit
+from whoosh.sorting import Count
+from whoosh.sorting import FieldFacet
 #from whoosh.fields import ID, TEXT, KEYWORD, STORED
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import heapq
+import itertools
 import os
+import threading
+import time
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
 
 
 __searchable__ = '__searchable__'
+__whoosh_autocomplete__ = '__whoosh_autocomplete__'
+__whoosh_highlight__ = '__whoosh_highlight__'
+__whoosh_facets__ = '__whoosh_facets__'
+__whoosh_partition_by__ = '__whoosh_partition_by__'
+__whoosh_load__ = '__whoosh_load__'
 
 
 DEFAULT_WHOOSH_INDEX_NAME = 'whoosh_index'
 
+# Edge n-grams are indexed from a single character, so that every typed word
+# is looked up as one term. Longer prefixes are truncated to the longest gram.
+AUTOCOMPLETE_MIN_GRAM = 1
+AUTOCOMPLETE_MAX_GRAM = 15
+AUTOCOMPLETE_SUFFIX = '__autocomplete'
+
+FACET_SUFFIX = '__facet'
+
+DEFAULT_WHOOSH_AUTOCOMPLETE_CACHE_SIZE = 1024
+
+DEFAULT_WHOOSH_HIGHLIGHT_CACHE_SIZE = 1024
+DEFAULT_WHOOSH_HIGHLIGHT_MAXCHARS = 200
+
+DEFAULT_WHOOSH_WARMUP_THREADS = 4
+
+DEFAULT_WHOOSH_STREAM_CHUNK_SIZE = 100
+
+DEFAULT_WHOOSH_MAX_OPEN_PARTITIONS = 128
+
+# Changed objects with indexed relationships are reloaded in batches of this
+# many primary keys, keeping the ``IN`` clause within database limits.
+INDEX_LOAD_BATCH_SIZE = 500
+
+# Key of a row's instance state info holding the partition it is moving out
+# of, until the change is committed.
+_MOVED_FROM_PARTITION = 'whoosh_moved_from_partition'
+
+# Numbers the primary key parameter of each search, so that chained searches
+# do not collide.
+_search_param_counter = itertools.count()
+
+# Splits a typed prefix the same way NGRAMWORDS splits the indexed value.
+_autocomplete_tokenizer = RegexTokenizer() | LowercaseFilter()
+
 try:
     unicode
 except NameError:
     unicode = str
 
+class _LRUCache(object):
+    # Small thread-safe LRU mapping used to memoize hot lookups against an
+    # index. It is cleared whenever the index is written to.
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class _Counter(object):
+    # Thread-safe counter, shared by all the partitions of a model.
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def increment(self):
+        with self._lock:
+            self.value += 1
+
+
 class _QueryProxy(flask_sqlalchemy.BaseQuery):
     # We're replacing the model's ``query`` field with this proxy. The main
     # thing this proxy does is override the __iter__ method so that results are
@@ -57,6 +170,19 @@ class _QueryProxy(flask_sqlalchemy.BaseQuery):
         # whoosh query was performed.
         self._whoosh_rank = None
 
+        # Name of the expanding parameter bound to the primary keys of the
+        # Whoosh results.
+        self._whoosh_param = None
+
+        # Maps primary key -> {field: fragment} for highlighted searches.
+        self._whoosh_highlights = {}
+
+        # Maps facet -> {value: count} for faceted searches.
+        self._whoosh_facets = {}
+
+        # Whether the Whoosh search ran out of time before completing.
+        self._whoosh_partial = False
+
     def __iter__(self):
         ''' Reorder ORM-db results according to Whoosh relevance score. '''
 
@@ -84,7 +210,46 @@ class _QueryProxy(flask_sqlalchemy.BaseQuery):
 
         return _inner()
 
-    def whoosh_search(self, query, limit=None, fields=None, or_=False):
+    def whoosh_stream(self, chunk_size=DEFAULT_WHOOSH_STREAM_CHUNK_SIZE):
+        ''' Iterate over the results in Whoosh rank order, loading
+        ``chunk_size`` rows at a time.
+
+        Unlike plain iteration, which fetches every matching row before
+        yielding the first one, each chunk is fetched only once the previous
+        one has been consumed, so memory use does not grow with the number
+        of hits. Queries without a Whoosh search are iterated with
+        ``yield_per(chunk_size)``.
+
+        Every chunk re-runs the query, so a Whoosh search with ``limit()`` or
+        ``offset()`` cannot be streamed and raises ``ValueError``; pass
+        ``limit`` to ``whoosh_search`` instead.
+
+        '''
+
+        if self._whoosh_rank is None:
+            for row in self.yield_per(chunk_size):
+                yield row
+            return
+
+        # SQLAlchemy 1.4 renamed these to _limit_clause and _offset_clause.
+        if any(getattr(self, name, None) is not None for name in ('_limit',
+                '_offset', '_limit_clause', '_offset_clause')):
+            raise ValueError('whoosh_stream cannot be used on a query with a '
+                    'limit or offset')
+
+        ranked = sorted(self._whoosh_rank, key=self._whoosh_rank.get)
+
+        for start in range(0, len(ranked), chunk_size):
+            # Rebinding the search's primary keys to the chunk keeps each
+            # statement to the chunk's keys. Each chunk is re-ordered by rank
+            # in __iter__.
+            for row in self.params({self._whoosh_param:
+                    ranked[start:start + chunk_size]}):
+                yield row
+
+    def whoosh_search(self, query, limit=None, fields=None, or_=False,
+            highlight=None, facets=None, partition=None, timeout=None,
+            max_doc_frequency=None):
         '''
 
         Execute text query on database. Results have a text-based
@@ -102,12 +267,38 @@ class _QueryProxy(flask_sqlalchemy.BaseQuery):
         query terms (AND). To switch to an OR grouping, set the ``or_``
         parameter to ``True``.
 
+        To get matching fragments of some fields, list them in
+        ``highlight``; they must be declared in the model's
+        ``__whoosh_highlight__``. The fragments are then available through
+        ``whoosh_highlights``.
+
+        To count hits per value of some columns, list them in ``facets``;
+        they must be declared in the model's ``__whoosh_facets__``. The
+        counts are then available through ``whoosh_facets``.
+
+        For models with ``__whoosh_partition_by__``, ``partition`` selects
+        the value whose sub-index is searched, and is required.
+
+        ``timeout`` (seconds, defaulting to ``WHOOSH_SEARCH_TIMEOUT``) bounds
+        the time spent in Whoosh; when it is exceeded the best results found
+        so far are used and ``whoosh_partial`` returns ``True``. With
+        ``or_``, terms found in more than the ``max_doc_frequency`` fraction
+        of documents (defaulting to ``WHOOSH_MAX_DOC_FREQUENCY``) are dropped
+        from the query, unless that would drop every term.
+
         '''
 
         if not isinstance(query, unicode):
             query = unicode(query)
 
-        results = self._whoosh_searcher(query, limit, fields, or_)
+        searcher = self._whoosh_searcher.partition(partition)
+
+        results = searcher(query, limit, fields, or_, highlight=highlight,
+                facets=facets, timeout=timeout,
+                max_doc_frequency=max_doc_frequency)
+
+        if facets:
+            facet_counts = searcher.facet_counts(results, facets)
 
         if not results:
             # We don't want to proceed with empty results because we get a
@@ -116,57 +307,561 @@ class _QueryProxy(flask_sqlalchemy.BaseQuery):
             # be a query.
 
             # XXX is this efficient?
-            return self.filter(sqlalchemy.text('null'))
+            f = self.filter(sqlalchemy.text('null'))
+
+            if facets:
+                f._whoosh_facets = facet_counts
+
+            f._whoosh_partial = results.partial
+
+            return f
 
         result_set = set()
         result_ranks = {}
+        result_highlights = {}
 
         for rank, result in enumerate(results):
+            if limit is not None and rank >= limit:
+                # Whoosh collects every hit when grouping for facets.
+                break
+
             pk = result[self._primary_key_name]
             result_set.add(pk)
             result_ranks[pk] = rank
 
+            if highlight:
+                result_highlights[pk] = searcher.highlights(result, highlight)
+
+        param = 'whoosh_%d' % next(_search_param_counter)
         f = self.filter(getattr(self._modelclass,
-            self._primary_key_name).in_(result_set))
+            self._primary_key_name).in_(sqlalchemy.bindparam(param,
+                expanding=True))).params({param: list(result_set)})
+
+        if partition is not None:
+            # Guards against stale documents in this sub-index, e.g. from a
+            # row moved out of it while updating the index failed.
+            f = f.filter(getattr(self._modelclass,
+                self._whoosh_searcher.partition_by) == partition)
 
         f._whoosh_rank = result_ranks
+        f._whoosh_param = param
+        f._whoosh_partial = results.partial
+
+        if highlight:
+            f._whoosh_highlights = result_highlights
+
+        if facets:
+            f._whoosh_facets = facet_counts
 
         return f
 
+    def whoosh_highlights(self, instance):
+        ''' Return the ``{field: fragment}`` mapping computed for
+        ``instance`` by ``whoosh_search(..., highlight=...)``. Fields with no
+        match in ``instance`` map to an empty string. '''
+
+        return self._whoosh_highlights.get(unicode(getattr(instance,
+            self._primary_key_name)), {})
+
+    def whoosh_facets(self):
+        ''' Return the ``{facet: {value: count}}`` mapping computed by
+        ``whoosh_search(..., facets=...)``. Counts cover every Whoosh hit,
+        regardless of ``limit`` or of SQL filters applied afterwards. '''
+
+        return self._whoosh_facets
+
+    def whoosh_partial(self):
+        ''' Return ``True`` if the last ``whoosh_search`` hit its time limit,
+        so that its results are the best found in time rather than the best
+        overall. '''
+
+        return self._whoosh_partial
+
+
+class WhooshAlchemy(object):
+    ''' Flask extension that opens the whoosh index of every
+    ``__searchable__`` model when the application starts::
+
+        db = SQLAlchemy(app)
+        whoosh = WhooshAlchemy(app, db)
+
+    Without it, an index is opened on the first commit of its model, and
+    ``whoosh_search`` and ``pure_whoosh`` are unavailable until then. If
+    ``WHOOSH_WARMUP`` is set, the indexes are also warmed up in parallel
+    over ``WHOOSH_WARMUP_THREADS`` threads. Timings are logged and kept in
+    ``app.whoosh_timings``.
+
+    '''
+
+    def __init__(self, app=None, db=None):
+        self.db = db
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, db=None):
+        db = db or self.db
+
+        if db is None:
+            try:
+                state = app.extensions['sqlalchemy']
+            except KeyError:
+                raise RuntimeError('WhooshAlchemy needs a Flask-SQLAlchemy '
+                        'instance; pass it or initialise it first')
+
+            # Flask-SQLAlchemy 2 registers a state object, 3 the db itself.
+            db = getattr(state, 'db', state)
+
+        app.config.setdefault('WHOOSH_BASE', DEFAULT_WHOOSH_INDEX_NAME)
+        app.config.setdefault('WHOOSH_WARMUP', False)
+        app.config.setdefault('WHOOSH_WARMUP_THREADS',
+                DEFAULT_WHOOSH_WARMUP_THREADS)
+
+        app.extensions['whooshalchemy'] = self
+
+        models = searchable_models(db)
+
+        start = time.time()
+        for model in models:
+            _get_searcher(app, model)
+
+        app.whoosh_timings = {'open': time.time() - start, 'warmup': {}}
+        app.logger.info('Opened %d whoosh indexes in %.3fs', len(models),
+                app.whoosh_timings['open'])
+
+        if app.config['WHOOSH_WARMUP']:
+            self.warm_up(app, models)
+
+    def warm_up(self, app, models):
+        ''' Warm up the indexes of ``models`` in parallel. Returns a dict
+        of model name -> seconds spent. '''
+
+        def _warm_up(model):
+            start = time.time()
+            model.pure_whoosh.warm_up()
+            return model.__name__, time.time() - start
+
+        start = time.time()
+        pool = ThreadPool(max(1, min(len(models),
+            app.config.get('WHOOSH_WARMUP_THREADS',
+                DEFAULT_WHOOSH_WARMUP_THREADS))))
+        try:
+            timings = dict(pool.map(_warm_up, models))
+        finally:
+            pool.close()
+            pool.join()
+
+        app.whoosh_timings = dict(getattr(app, 'whoosh_timings', {}),
+                warmup=timings)
+        app.logger.info('Warmed up %d whoosh indexes in %.3fs', len(models),
+                time.time() - start)
+
+        return timings
+
+
+def searchable_models(db):
+    ''' Return every model of ``db`` that declares ``__searchable__``. '''
+
+    models = []
+    pending = list(db.Model.__subclasses__())
+
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+
+        if hasattr(cls, __searchable__) and hasattr(cls, '__table__') and \
+                cls not in models:
+            models.append(cls)
+
+    return sorted(models, key=lambda model: model.__name__)
+
 
 class _Searcher(object):
     ''' Assigned to a Model class as ``pure_search``, which enables
     text-querying to whoosh hit list. Also used by ``query.whoosh_search``'''
 
-    def __init__(self, primary, indx):
+    def __init__(self, primary, indx,
+            cache_size=DEFAULT_WHOOSH_AUTOCOMPLETE_CACHE_SIZE,
+            fieldboosts=None, weighting=None, highlighter=None,
+            highlight_cache_size=DEFAULT_WHOOSH_HIGHLIGHT_CACHE_SIZE,
+            timeout=None, max_doc_frequency=None, timeouts=None):
         self.primary_key_name = primary
         self._index = indx
-        self.searcher = indx.searcher()
+        self._timeout = timeout
+        self._max_doc_frequency = max_doc_frequency
+        self._timeouts = timeouts or _Counter()
+        self._fieldboosts = fieldboosts or {}
+        self._weighting = weighting
+        self._highlighter = highlighter or Highlighter(
+                fragmenter=PinpointFragmenter(autotrim=True))
+        self._searcher_lock = threading.Lock()
+        self._searcher_generation = indx.latest_generation()
+        self.searcher = self._open_searcher()
+        self._autocomplete_fields = [name for name in indx.schema.names()
+                if name.endswith(AUTOCOMPLETE_SUFFIX)]
+        self._facet_fields = [name for name in indx.schema.names()
+                if name.endswith(FACET_SUFFIX)]
         self._all_fields = list(set(indx.schema._fields.keys()) -
-                set([self.primary_key_name]))
-
-    def __call__(self, query, limit=None, fields=None, or_=False):
+                set([self.primary_key_name]) -
+                set(self._autocomplete_fields) -
+                set(self._facet_fields))
+        self._highlight_fields = frozenset(name for name, field
+                in indx.schema.items() if field.stored and
+                field.supports('characters'))
+        self._suggest_cache = _LRUCache(cache_size)
+        self._highlight_cache = _LRUCache(highlight_cache_size)
+
+    @property
+    def timed_out_searches(self):
+        ''' Number of searches that exceeded their time limit. '''
+
+        return self._timeouts.value
+
+    def __call__(self, query, limit=None, fields=None, or_=False,
+            highlight=None, facets=None, timeout=None,
+            max_doc_frequency=None):
         if fields is None:
             fields = self._all_fields
 
+        if timeout is None:
+            timeout = self._timeout
+
+        if max_doc_frequency is None:
+            max_doc_frequency = self._max_doc_frequency
+
+        groupedby = None
+        if facets:
+            groupedby = {}
+            for facet in facets:
+                name = facet + FACET_SUFFIX
+                if name not in self._facet_fields:
+                    raise ValueError('Field {0} is not in {1}'.format(facet,
+                        __whoosh_facets__))
+
+                groupedby[facet] = FieldFacet(name, maptype=Count)
+
+        if highlight:
+            unknown = set(highlight) - self._highlight_fields
+            if unknown:
+                raise ValueError('Fields {0} are not in {1}'.format(
+                    ', '.join(sorted(unknown)), __whoosh_highlight__))
+
         group = OrGroup if or_ else AndGroup
-        parser = MultifieldParser(fields, self._index.schema, group=group)
-        return self._index.searcher().search(parser.parse(query),
-                limit=limit)
+        parser = MultifieldParser(fields, self._index.schema,
+                fieldboosts=self._fieldboosts, group=group)
+
+        searcher = self._current_searcher()
+        q = parser.parse(query)
+
+        if or_ and max_doc_frequency:
+            q = _drop_common_terms(q, searcher, max_doc_frequency)
+
+        # Highlighting needs to know which terms matched in each hit.
+        collector = searcher.collector(limit=limit, terms=bool(highlight),
+                groupedby=groupedby)
+
+        if timeout:
+            # Not SIGALRM: it only works in the main thread.
+            collector = TimeLimitCollector(collector, timeout,
+                    use_alarm=False)
+
+        partial = False
+        try:
+            searcher.search_with_collector(q, collector)
+        except TimeLimit:
+            partial = True
+            self._timeouts.increment()
+
+        results = collector.results()
+        results.partial = partial
+
+        return results
+
+    def facet_counts(self, results, facets):
+        ''' Return ``{facet: {value: count}}`` for a search run with
+        ``facets``. Documents without a value for a facet are not counted. '''
+
+        counts = {}
+        for facet in facets:
+            counts[facet] = dict((value, count) for value, count
+                    in results.groups(facet).items() if value)
+
+        return counts
+
+    def highlights(self, hit, fields):
+        ''' Return ``{field: fragment}`` for a hit of a search run with
+        ``highlight``. Fragments are built from the character offsets stored
+        at indexing time and cached per (document, query) and index
+        generation. '''
+
+        hit.results.highlighter = self._highlighter
+        query_key = (hit.searcher.reader().generation(), repr(hit.results.q))
+        fragments = {}
+
+        for field in fields:
+            key = (hit[self.primary_key_name], field, query_key)
+            fragment = self._highlight_cache.get(key)
+
+            if fragment is None:
+                fragment = hit.highlights(field) if field in hit else u''
+                self._highlight_cache.set(key, fragment)
+
+            fragments[field] = fragment
+
+        return fragments
+
+    def suggest(self, prefix, limit=10, fields=None):
+        ''' Return up to ``limit`` stored values of the
+        ``__whoosh_autocomplete__`` fields that start with ``prefix``.
+
+        Every word of ``prefix`` must prefix a word of the value, so
+        ``'hel wo'`` completes to ``'hello world'``. Lookups go straight to
+        the edge n-gram terms written at indexing time, and hot prefixes are
+        answered from an in-memory cache keyed by index generation.
+
+        '''
+
+        if fields is None:
+            fields = self._autocomplete_fields
+        else:
+            unknown = [f for f in fields
+                    if f + AUTOCOMPLETE_SUFFIX not in self._autocomplete_fields]
+            if unknown:
+                raise ValueError('Fields {0} are not in {1}'.format(
+                    ', '.join(sorted(unknown)), __whoosh_autocomplete__))
+
+            fields = [f + AUTOCOMPLETE_SUFFIX for f in fields]
 
+        words = [t.text for t in _autocomplete_tokenizer(unicode(prefix))]
 
-def whoosh_index(app, model):
+        if not words or not fields:
+            return []
+
+        searcher = self._current_searcher()
+
+        # Keyed by index generation, so writes by other processes are seen.
+        key = (searcher.reader().generation(), tuple(words), tuple(fields),
+                limit)
+        suggestions = self._suggest_cache.get(key)
+
+        if suggestions is None:
+            suggestions = self._suggest(searcher, words, fields, limit)
+            self._suggest_cache.set(key, suggestions)
+
+        return list(suggestions)
+
+    def _current_searcher(self):
+        # Returns the shared searcher, reopened if the index changed since it
+        # was opened, possibly by another process. The old searcher is not
+        # closed, as other threads may still be reading from it; its files
+        # are released once they are done with it.
+
+        with self._searcher_lock:
+            # Not Searcher.up_to_date(), which is never true for an empty
+            # index.
+            generation = self._index.latest_generation()
+
+            if self.searcher is None or \
+                    generation != self._searcher_generation:
+                self._searcher_generation = generation
+                self.searcher = self._open_searcher()
+
+            return self.searcher
+
+    def _open_searcher(self):
+        if self._weighting is None:
+            return self._index.searcher()
+
+        return self._index.searcher(weighting=self._weighting)
+
+    def _suggest(self, searcher, words, fields, limit):
+        per_field = []
+        for field in fields:
+            terms = [Term(field, word[:AUTOCOMPLETE_MAX_GRAM])
+                    for word in words]
+            per_field.append((field, And(terms)))
+
+        suggestions = []
+        seen = set()
+
+        for field, query in per_field:
+            for hit in searcher.search(query, limit=limit):
+                value = hit.get(field)
+
+                if value is not None and value not in seen:
+                    seen.add(value)
+                    suggestions.append(value)
+
+        return tuple(suggestions[:limit])
+
+    def warm_up(self):
+        ''' Load the segment readers of the index and read through its
+        sortable columns. Searches share this searcher until the index
+        changes, so the first ones do not pay for it. '''
+
+        reader = self._current_searcher().reader()
+
+        for field in self._facet_fields:
+            if reader.has_column(field):
+                for _ in reader.column_reader(field):
+                    pass
+
+    def invalidate(self):
+        ''' Drop cached lookups; called after the index is written. '''
+
+        self._suggest_cache.clear()
+        self._highlight_cache.clear()
+
+    def partition(self, value):
+        if value is not None:
+            raise ValueError('Index is not partitioned; it has no {0}'.format(
+                __whoosh_partition_by__))
+
+        return self
+
+    def close(self):
+        # Drop rather than close the searcher: a search on another thread may
+        # still be using it.
+        with self._searcher_lock:
+            self.searcher = None
+
+
+def _drop_common_terms(q, searcher, max_doc_frequency):
+    # Replaces terms found in more than ``max_doc_frequency`` of the documents
+    # by a null query. Returns ``q`` untouched if no remaining term occurs in
+    # the index, since the query could then not match anything.
+
+    cutoff = max_doc_frequency * searcher.doc_count()
+
+    def drop(sub):
+        if isinstance(sub, Term) and \
+                searcher.doc_frequency(sub.fieldname, sub.text) > cutoff:
+            return NullQuery
+
+        return sub
+
+    pruned = q.accept(drop).normalize()
+
+    for fieldname, text in pruned.iter_all_terms():
+        if searcher.doc_frequency(fieldname, text):
+            return pruned
+
+    return q
+
+
+class _PartitionedSearcher(object):
+    ''' Assigned to a Model class with ``__whoosh_partition_by__`` as
+    ``pure_whoosh``. Keeps one sub-index per partition value, each with its
+    own ``_Searcher``, of which at most ``max_open`` are kept open. '''
+
+    def __init__(self, primary, path, schema, partition_by,
+            max_open=DEFAULT_WHOOSH_MAX_OPEN_PARTITIONS, **kwargs):
+        self.primary_key_name = primary
+        self.partition_by = partition_by
+        self._path = path
+        self._schema = schema
+        self._max_open = max_open
+        self._timeouts = _Counter()
+        self._kwargs = dict(kwargs, timeouts=self._timeouts)
+        self._partitions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def partition(self, value):
+        ''' Return the ``_Searcher`` of partition ``value``, opening (or
+        creating) its index if needed. '''
+
+        if value is None:
+            raise ValueError('Index is partitioned by {0}; a partition value '
+                    'is required'.format(self.partition_by))
+
+        key = unicode(value)
+        closed = []
+
+        with self._lock:
+            searcher = self._partitions.pop(key, None)
+
+            if searcher is None:
+                path = os.path.join(self._path,
+                        quote(key.encode('utf-8'), safe=''))
+                searcher = _Searcher(self.primary_key_name,
+                        _open_index(path, self._schema), **self._kwargs)
+
+            self._partitions[key] = searcher
+
+            while len(self._partitions) > self._max_open:
+                closed.append(self._partitions.popitem(last=False)[1])
+
+        for evicted in closed:
+            evicted.close()
+
+        return searcher
+
+    @property
+    def timed_out_searches(self):
+        ''' Number of searches that exceeded their time limit, across all
+        partitions. '''
+
+        return self._timeouts.value
+
+    def __call__(self, query, limit=None, fields=None, or_=False,
+            partition=None, **kwargs):
+        return self.partition(partition)(query, limit, fields, or_, **kwargs)
+
+    def suggest(self, prefix, limit=10, fields=None, partition=None):
+        return self.partition(partition).suggest(prefix, limit, fields)
+
+    def warm_up(self):
+        with self._lock:
+            searchers = list(self._partitions.values())
+
+        for searcher in searchers:
+            searcher.warm_up()
+
+    def invalidate(self):
+        with self._lock:
+            searchers = list(self._partitions.values())
+
+        for searcher in searchers:
+            searcher.invalidate()
+
+    def close(self):
+        with self._lock:
+            searchers = list(self._partitions.values())
+            self._partitions.clear()
+
+        for searcher in searchers:
+            searcher.close()
+
+
+def whoosh_index(app, model, partition=None):
     ''' Create whoosh index for ``model``, if one does not exist. If
-    the index exists it is opened and cached. '''
+    the index exists it is opened and cached. For a model with
+    ``__whoosh_partition_by__``, this is the index of ``partition``. '''
 
-    # gets the whoosh index for this model, creating one if it does not exist.
-    # A dict of model -> whoosh index is added to the ``app`` variable.
+    searcher = _get_searcher(app, model)
+
+    if getattr(model, __whoosh_partition_by__, None):
+        return searcher.partition(partition)._index
+
+    return app.whoosh_indexes[model.__name__]
+
+def _get_searcher(app, model):
+    # gets the whoosh searcher for this model, creating the index if it does
+    # not exist. Dicts of model -> whoosh index and model -> searcher are
+    # added to the ``app`` variable.
 
     if not hasattr(app, 'whoosh_indexes'):
         app.whoosh_indexes = {}
+        app.whoosh_searchers = {}
+
+    if model.__name__ not in app.whoosh_searchers:
+        _create_index(app, model)
 
-    return app.whoosh_indexes.get(model.__name__,
-                _create_index(app, model))
+    # The searcher is bound to the model class, which may be shared by
+    # several applications.
+    model.pure_whoosh = app.whoosh_searchers[model.__name__]
+
+    return model.pure_whoosh
 
 def _get_analyzer(app, model):
     analyzer = getattr(model, '__analyzer__', None)
@@ -179,6 +874,36 @@ def _get_analyzer(app, model):
 
     return analyzer
 
+def _get_weighting(app, model):
+    weighting = getattr(model, '__weighting__', None)
+
+    if not weighting and app.config.get('WHOOSH_WEIGHTING'):
+        weighting = app.config['WHOOSH_WEIGHTING']
+
+    return weighting
+
+def _get_highlighter(app):
+    fragmenter = PinpointFragmenter(
+            maxchars=app.config.get('WHOOSH_HIGHLIGHT_MAXCHARS',
+                DEFAULT_WHOOSH_HIGHLIGHT_MAXCHARS),
+            charlimit=app.config.get('WHOOSH_HIGHLIGHT_CHARLIMIT',
+                DEFAULT_CHARLIMIT),
+            autotrim=True)
+
+    return Highlighter(fragmenter=fragmenter)
+
+def _get_fieldboosts(model):
+    # ``__searchable__`` may map field names to weights, e.g.
+    # ``{'title': 3.0, 'content': 1.0}``; a plain sequence means no boosts.
+
+    searchable = model.__searchable__
+
+    if not isinstance(searchable, dict):
+        return {}
+
+    return dict((field, float(boost)) for field, boost in searchable.items()
+            if float(boost) != 1.0)
+
 def _create_index(app, model):
     # a schema is created based on the fields of the model. Currently we only
     # support primary key -> whoosh.ID, and sqlalchemy.(String, Unicode, Text)
@@ -199,17 +924,32 @@ def _create_index(app, model):
     analyzer = _get_analyzer(app, model)
     schema, primary_key = _get_whoosh_schema_and_primary_key(model, analyzer)
 
-    if whoosh.index.exists_in(wi):
-        indx = whoosh.index.open_dir(wi)
+    options = dict(
+            cache_size=app.config.get('WHOOSH_AUTOCOMPLETE_CACHE_SIZE',
+                DEFAULT_WHOOSH_AUTOCOMPLETE_CACHE_SIZE),
+            fieldboosts=_get_fieldboosts(model),
+            weighting=_get_weighting(app, model),
+            highlighter=_get_highlighter(app),
+            highlight_cache_size=app.config.get('WHOOSH_HIGHLIGHT_CACHE_SIZE',
+                DEFAULT_WHOOSH_HIGHLIGHT_CACHE_SIZE),
+            timeout=app.config.get('WHOOSH_SEARCH_TIMEOUT'),
+            max_doc_frequency=app.config.get('WHOOSH_MAX_DOC_FREQUENCY'))
+
+    partition_by = getattr(model, __whoosh_partition_by__, None)
+
+    if partition_by:
+        # one sub-index per partition value, opened on demand.
+        indx = None
+        model.pure_whoosh = _PartitionedSearcher(primary_key, wi, schema,
+                partition_by, app.config.get('WHOOSH_MAX_OPEN_PARTITIONS',
+                    DEFAULT_WHOOSH_MAX_OPEN_PARTITIONS), **options)
     else:
-        if not os.path.exists(wi):
-            os.makedirs(wi)
-        indx = whoosh.index.create_in(wi, schema)
+        indx = _open_index(wi, schema)
+        app.whoosh_indexes[model.__name__] = indx
+        model.pure_whoosh = _Searcher(primary_key, indx, **options)
 
-    app.whoosh_indexes[model.__name__] = indx
-
-    model.pure_whoosh = _Searcher(primary_key, indx)
     model.whoosh_primary_key = primary_key
+    app.whoosh_searchers[model.__name__] = model.pure_whoosh
 
     # change the query class of this model to our own
     model.query_class = _QueryProxy
@@ -217,10 +957,32 @@ def _create_index(app, model):
     return indx
 
 
+def _open_index(path, schema):
+    if whoosh.index.exists_in(path):
+        return whoosh.index.open_dir(path)
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    return whoosh.index.create_in(path, schema)
+
+
 def _get_whoosh_schema_and_primary_key(model, analyzer):
     schema = {}
     primary = None
     searchable = set(model.__searchable__)
+    autocomplete = set(getattr(model, __whoosh_autocomplete__, ()))
+    highlight = set(getattr(model, __whoosh_highlight__, ()))
+    facets = set(getattr(model, __whoosh_facets__, ()))
+
+    def text_field(name):
+        if name in highlight:
+            # Store the text and its character offsets so fragments can be
+            # cut without re-analysing the document.
+            return whoosh.fields.TEXT(analyzer=analyzer, stored=True,
+                    chars=True)
+
+        return whoosh.fields.TEXT(analyzer=analyzer)
 
     for field in model.__table__.columns:
         if field.primary_key:
@@ -231,47 +993,256 @@ def _get_whoosh_schema_and_primary_key(model, analyzer):
                 (sqlalchemy.types.Text, sqlalchemy.types.String,
                     sqlalchemy.types.Unicode)):
 
-            schema[field.name] = whoosh.fields.TEXT(analyzer=analyzer)
+            schema[field.name] = text_field(field.name)
+
+        if field.name in autocomplete:
+            schema[field.name + AUTOCOMPLETE_SUFFIX] = whoosh.fields.NGRAMWORDS(
+                    minsize=AUTOCOMPLETE_MIN_GRAM,
+                    maxsize=AUTOCOMPLETE_MAX_GRAM, at='start', stored=True)
+
+        if field.name in facets:
+            # Counted from the per-segment column cache at search time.
+            schema[field.name + FACET_SUFFIX] = whoosh.fields.ID(
+                    sortable=True)
+
+    for name in searchable:
+        if name not in model.__table__.columns and _is_computed(model, name):
+            schema[name] = text_field(name)
 
     return Schema(**schema), primary
 
 
+def _is_computed(model, name):
+    # Besides text columns, ``__searchable__`` may name a relationship
+    # (optionally followed by a dotted attribute path, e.g. 'tags.name'), a
+    # hybrid or plain property, or a method, all indexed as text.
+
+    mapper = class_mapper(model)
+    root = name.split('.')[0]
+
+    if root in mapper.relationships:
+        return True
+
+    descriptor = mapper.all_orm_descriptors.get(root)
+    if descriptor is not None and \
+            descriptor.extension_type is HYBRID_PROPERTY:
+        return True
+
+    for cls in model.__mro__:
+        if root in cls.__dict__:
+            attr = cls.__dict__[root]
+            return isinstance(attr, property) or callable(attr)
+
+    return False
+
+
+def _relationship_paths(model, searchable):
+    # Returns loader options that eagerly load, in one query per
+    # relationship, every relationship named in ``searchable`` or in the
+    # model's ``__whoosh_load__``, which lists the relationship paths read by
+    # its computed fields.
+
+    options = []
+
+    for name in list(searchable) + list(getattr(model, __whoosh_load__, ())):
+        mapper = class_mapper(model)
+        option = None
+
+        for attr in name.split('.'):
+            if attr not in mapper.relationships:
+                break
+
+            prop = getattr(mapper.class_, attr)
+            option = selectinload(prop) if option is None else \
+                    option.selectinload(prop)
+            mapper = mapper.relationships[attr].mapper
+
+        if option is not None:
+            options.append(option)
+
+    return options
+
+
+def _load_for_indexing(loader, model, instances, primary_field, searchable):
+    # ``models_committed`` is sent from within the commit, when the session
+    # can no longer emit SQL, so relationships cannot be lazily read from the
+    # changed objects, not even by a hybrid or method. Load the committed rows
+    # in bulk on the separate ``loader`` session instead, with one query per
+    # relationship, and return them keyed by primary key. The loader must
+    # stay open while the documents are built, for anything not preloaded.
+
+    options = _relationship_paths(model, searchable)
+    column = getattr(model, primary_field)
+    keys = [getattr(v, primary_field) for v in instances]
+    loaded = {}
+
+    for start in range(0, len(keys), INDEX_LOAD_BATCH_SIZE):
+        for obj in loader.query(model).filter(column.in_(
+                keys[start:start + INDEX_LOAD_BATCH_SIZE])).options(*options):
+            loaded[getattr(obj, primary_field)] = obj
+
+    return loaded
+
+
+def _searchable_value(obj, name):
+    # Follows a dotted path from ``obj``, calling methods and flattening
+    # collections, and joins what it finds into a single text value.
+
+    values = [obj]
+    flattened = False
+
+    for attr in name.split('.'):
+        found = []
+
+        for value in values:
+            if value is None:
+                # An unset many-to-one link has nothing beyond it.
+                continue
+
+            value = getattr(value, attr)
+
+            if callable(value):
+                value = value()
+
+            if isinstance(value, (list, tuple, set)):
+                flattened = True
+                found.extend(value)
+            else:
+                found.append(value)
+
+        values = found
+
+    if not flattened and len(values) == 1:
+        return unicode(values[0])
+
+    return u' '.join(unicode(value) for value in values if value is not None)
+
+
 def _after_flush(app, changes):
     # Any db updates go through here. We check if any of these models have
     # ``__searchable__`` fields, indicating they need to be indexed. With these
     # we update the whoosh index for the model. If no index exists, it will be
     # created here; this could impose a penalty on the initial commit of a
-    # model.
+    # model, which ``WhooshAlchemy.init_app`` avoids by opening indexes at
+    # startup.
 
     bytype = {}  # sort changes by type so we can use per-model writer
     for change in changes:
         update = change[1] in ('update', 'insert')
 
         if hasattr(change[0].__class__, __searchable__):
-            bytype.setdefault(change[0].__class__.__name__, []).append((update,
-                change[0]))
-
-    for model, values in bytype.items():
-        index = whoosh_index(app, values[0][1].__class__)
-        with index.writer() as writer:
-            primary_field = values[0][1].pure_whoosh.primary_key_name
-            searchable = values[0][1].__searchable__
-
-            for update, v in values:
-                if update:
-                    attrs = {}
-                    for key in searchable:
-                        try:
-                            attrs[key] = unicode(getattr(v, key))
-                        except AttributeError:
-                            raise AttributeError('{0} does not have {1} field {2}'
-                                    .format(model, __searchable__, key))
-
-                    attrs[primary_field] = unicode(getattr(v, primary_field))
-                    writer.update_document(**attrs)
-                else:
-                    writer.delete_by_term(primary_field, unicode(getattr(v,
-                        primary_field)))
+            name = change[0].__class__.__name__
+
+            # partitioned models get one writer per partition
+            partition_by = getattr(change[0], __whoosh_partition_by__, None)
+            partition = None
+
+            if partition_by:
+                partition = getattr(change[0], partition_by)
+
+                # drop the document from the partition the row moved out of
+                moved_from = sqlalchemy.inspect(change[0]).info.pop(
+                        _MOVED_FROM_PARTITION, None)
+                if moved_from is not None and moved_from != partition:
+                    bytype.setdefault((name, moved_from), []).append(
+                            (False, change[0]))
+
+                if partition is None:
+                    # rows without a partition value are not indexed
+                    continue
+
+            bytype.setdefault((name, partition), []).append(
+                    (update, change[0]))
+
+    for (model, partition), values in bytype.items():
+        cls = values[0][1].__class__
+        index = whoosh_index(app, cls, partition)
+
+        primary_field = values[0][1].pure_whoosh.primary_key_name
+        searchable = values[0][1].__searchable__
+        autocomplete = getattr(values[0][1], __whoosh_autocomplete__, ())
+        facets = getattr(values[0][1], __whoosh_facets__, ())
+
+        updated = [v for update, v in values if update]
+        session = object_session(updated[0]) if updated else None
+        loader = None
+        loaded = {}
+
+        if session is not None and any(name not in cls.__table__.columns and
+                _is_computed(cls, name) for name in searchable):
+            loader = Session(bind=session.get_bind(class_mapper(cls)))
+            loaded = _load_for_indexing(loader, cls, updated, primary_field,
+                    searchable)
+
+        try:
+            with index.writer() as writer:
+
+                for update, v in values:
+                    if update:
+                        source = loaded.get(getattr(v, primary_field), v)
+
+                        attrs = {}
+                        for key in searchable:
+                            try:
+                                attrs[key] = _searchable_value(source, key)
+                            except AttributeError:
+                                raise AttributeError(
+                                        '{0} does not have {1} field {2}'
+                                        .format(model, __searchable__, key))
+
+                        for key in autocomplete:
+                            value = getattr(v, key, None)
+                            if value is not None:
+                                attrs[key + AUTOCOMPLETE_SUFFIX] = \
+                                        unicode(value)
+
+                        for key in facets:
+                            value = getattr(v, key, None)
+                            if value is not None:
+                                attrs[key + FACET_SUFFIX] = unicode(value)
+
+                        attrs[primary_field] = unicode(getattr(v,
+                            primary_field))
+                        writer.update_document(**attrs)
+                    else:
+                        writer.delete_by_term(primary_field, unicode(getattr(v,
+                            primary_field)))
+        finally:
+            if loader is not None:
+                loader.close()
+
+        values[0][1].pure_whoosh.partition(partition).invalidate()
+
+
+def _before_flush(session, flush_context, instances):
+    # ``models_committed`` only sees the new value of a changed partition
+    # column, so remember the committed one here, while it can still be
+    # loaded, for ``_after_flush`` to delete the row from its old sub-index.
+
+    for obj in list(session.dirty) + list(session.deleted):
+        partition_by = getattr(obj, __whoosh_partition_by__, None)
+
+        if not partition_by or not hasattr(obj, __searchable__):
+            continue
+
+        state = sqlalchemy.inspect(obj)
+        history = state.attrs[partition_by].history
+
+        if not history.added or _MOVED_FROM_PARTITION in state.info:
+            continue
+
+        if history.deleted:
+            moved_from = history.deleted[0]
+        else:
+            # The column was assigned without being loaded first.
+            mapper = class_mapper(obj.__class__)
+            with session.no_autoflush:
+                moved_from = session.query(getattr(obj.__class__,
+                    partition_by)).filter(*[column == value for column, value
+                        in zip(mapper.primary_key, state.identity)]).scalar()
+
+        state.info[_MOVED_FROM_PARTITION] = moved_from
 
 
 flask_sqlalchemy.models_committed.connect(_after_flush)
+sqlalchemy.event.listen(Session, 'before_flush', _before_flush)
@@ -18,6 +18,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_testing import TestCase
 import flask_whooshalchemy as wa
 from whoosh.analysis import StemmingAnalyzer, DoubleMetaphoneFilter
+from whoosh.query import Term
+
+from sqlalchemy.ext.hybrid import hybrid_property
 
 import datetime
 import os
@@ -65,6 +68,91 @@ class ObjectD(db.Model, BlogishBlob):
     __analyzer__ = StemmingAnalyzer() | DoubleMetaphoneFilter()
 
 
+class ObjectE(db.Model, BlogishBlob):
+    __tablename__ = 'objectE'
+    __searchable__ = ['title', 'content']
+    __whoosh_autocomplete__ = ['title']
+
+
+class ObjectF(db.Model, BlogishBlob):
+    __tablename__ = 'objectF'
+    __searchable__ = {'title': 10.0, 'content': 1.0}
+
+
+class ObjectG(db.Model, BlogishBlob):
+    __tablename__ = 'objectG'
+    __searchable__ = ['title', 'content']
+    __whoosh_highlight__ = ['content']
+
+
+class ObjectH(db.Model, BlogishBlob):
+    __tablename__ = 'objectH'
+    __searchable__ = ['title', 'content']
+    __whoosh_facets__ = ['category']
+
+    category = db.Column(db.Unicode)
+
+
+class ObjectI(db.Model, BlogishBlob):
+    __tablename__ = 'objectI'
+    __searchable__ = ['title']
+    __whoosh_facets__ = ['title']
+
+
+class ObjectJ(db.Model, BlogishBlob):
+    __tablename__ = 'objectJ'
+    __searchable__ = ['title']
+    __whoosh_partition_by__ = 'tenant_id'
+
+    tenant_id = db.Column(db.Integer)
+
+
+class Author(db.Model):
+    __tablename__ = 'author'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.Unicode)
+
+
+class Tag(db.Model):
+    __tablename__ = 'tag'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.Unicode)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
+
+
+class Post(db.Model):
+    __tablename__ = 'post'
+    __searchable__ = ['title', 'author.name', 'tags.name', 'summary', 'shout']
+
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.Unicode)
+    author_id = db.Column(db.Integer, db.ForeignKey('author.id'))
+    author = db.relationship(Author)
+    tags = db.relationship(Tag)
+
+    @hybrid_property
+    def summary(self):
+        return u'summary of ' + self.title
+
+    def shout(self):
+        return self.title.upper() + u' LOUDLY'
+
+
+class Note(db.Model):
+    __tablename__ = 'note'
+    __searchable__ = ['title', 'author_name']
+    __whoosh_load__ = ['author']
+
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.Unicode)
+    author_id = db.Column(db.Integer, db.ForeignKey('author.id'))
+    author = db.relationship(Author)
+
+    @hybrid_property
+    def author_name(self):
+        return self.author.name
+
+
 class Tests(TestCase):
     DATABASE_URL = 'sqlite://'
     TESTING = True
@@ -284,6 +372,424 @@ class Tests(TestCase):
         self.assertEqual(len(list(ObjectD.query.whoosh_search('travelling'))), 3)
         self.assertEquals(len(list(ObjectD.query.whoosh_search('trovel'))), 3)
 
+    def test_suggest(self):
+        db.session.add(ObjectE(title=u'Hello World', content=u'greetings'))
+        db.session.add(ObjectE(title=u'help wanted', content=u'jobs'))
+        db.session.add(ObjectE(title=u'goodbye', content=u'hello'))
+        db.session.commit()
+
+        self.assertEqual(sorted(ObjectE.pure_whoosh.suggest(u'hel')),
+                [u'Hello World', u'help wanted'])
+        self.assertEqual(ObjectE.pure_whoosh.suggest(u'hel wo'),
+                [u'Hello World'])
+        self.assertEqual(ObjectE.pure_whoosh.suggest(u'g'), [u'goodbye'])
+        self.assertEqual(ObjectE.pure_whoosh.suggest(u'h wo'),
+                [u'Hello World'])
+
+        # one-letter words are looked up as a single term, not expanded
+        searcher = ObjectE.pure_whoosh._current_searcher()
+        queries = []
+        search = searcher.search
+        searcher.search = lambda q, **kwargs: queries.append(q) or search(q,
+                **kwargs)
+        try:
+            self.assertEqual(sorted(ObjectE.pure_whoosh.suggest(u'w')),
+                    [u'Hello World', u'help wanted'])
+        finally:
+            del searcher.search
+        self.assertTrue(queries)
+        for q in queries:
+            self.assertEqual(set(type(t) for t in q.leaves()), set([Term]))
+        self.assertEqual(ObjectE.pure_whoosh.suggest(u'xyz'), [])
+        self.assertEqual(len(ObjectE.pure_whoosh.suggest(u'hel', limit=1)), 1)
+
+        # the autocomplete field is not part of regular text search
+        self.assertEqual(len(list(ObjectE.query.whoosh_search(u'goodb'))), 0)
+
+        # cached suggestions are dropped once the index changes
+        db.session.add(ObjectE(title=u'helicopter', content=u''))
+        db.session.commit()
+        self.assertEqual(len(ObjectE.pure_whoosh.suggest(u'hel')), 3)
+
+        # a searcher that did not write (e.g. another process) sees changes
+        other = wa._Searcher(ObjectE.whoosh_primary_key,
+                self.app.whoosh_indexes['ObjectE'])
+        self.assertEqual(len(other.suggest(u'hel')), 3)
+        db.session.delete(ObjectE.query.filter_by(title=u'helicopter').one())
+        db.session.commit()
+        self.assertEqual(sorted(other.suggest(u'hel')),
+                [u'Hello World', u'help wanted'])
+
+        self.assertRaises(ValueError, ObjectE.pure_whoosh.suggest, u'hel',
+                fields=['content'])
+        self.assertEqual(ObjectE.pure_whoosh.suggest(u'hel', fields=['title'],
+            limit=1), [u'Hello World'])
+
+    def test_field_boosts(self):
+        db.session.add(ObjectF(title=u'other', content=u'apple apple pie'))
+        db.session.add(ObjectF(title=u'apple', content=u'a pie of sorts'))
+        db.session.commit()
+
+        l = list(ObjectF.query.whoosh_search(u'apple'))
+        self.assertEqual([obj.title for obj in l], [u'apple', u'other'])
+
+        l = list(ObjectF.query.whoosh_search(u'pie', fields=('content',)))
+        self.assertEqual(len(l), 2)
+
+    def test_custom_weighting(self):
+        from whoosh.scoring import Frequency
+        self.app.config['WHOOSH_WEIGHTING'] = Frequency()
+        db.session.add(ObjectA(title=u'pie', content=u'pie pie pie'))
+        db.session.add(ObjectA(title=u'pie', content=u'cake'))
+        db.session.commit()
+
+        l = list(ObjectA.query.whoosh_search(u'pie'))
+        self.assertEqual([obj.content for obj in l], [u'pie pie pie', u'cake'])
+
+    def test_highlight(self):
+        self.app.config['WHOOSH_HIGHLIGHT_MAXCHARS'] = 40
+        filler = u' '.join([u'filler'] * 50)
+        db.session.add(ObjectG(title=u'one',
+            content=filler + u' the quick brown fox ' + filler))
+        db.session.add(ObjectG(title=u'fox', content=u'nothing to see'))
+        db.session.commit()
+
+        q = ObjectG.query.whoosh_search(u'fox', or_=True, highlight=['content'])
+        l = list(q)
+        self.assertEqual(len(l), 2)
+
+        fragments = dict((obj.title, q.whoosh_highlights(obj)['content'])
+                for obj in l)
+        self.assertTrue(u'<b class="match term0">fox</b>' in fragments[u'one'])
+        self.assertTrue(len(fragments[u'one']) < 100)
+        self.assertFalse(u'<b' in fragments[u'fox'])
+
+        # highlights survive further chaining
+        q = q.filter(ObjectG.title == u'one')
+        self.assertTrue(u'fox' in q.whoosh_highlights(q.first())['content'])
+
+        self.assertEqual(ObjectG.query.whoosh_search(u'fox').whoosh_highlights(
+            l[0]), {})
+        self.assertRaises(ValueError, ObjectG.query.whoosh_search, u'fox',
+                highlight=['title'])
+        self.assertRaises(ValueError, ObjectG.query.whoosh_search, u'nothing',
+                highlight=['title'])
+
+        # cached fragments follow changes made through another searcher
+        other = wa._Searcher(ObjectG.whoosh_primary_key,
+                self.app.whoosh_indexes['ObjectG'])
+
+        def fragment():
+            hit = other(u'fox', fields=('content',), highlight=['content'])[0]
+            return other.highlights(hit, ['content'])['content']
+
+        self.assertTrue(u'quick' in fragment())
+        ObjectG.query.filter_by(title=u'one').one().content = u'a slow red fox'
+        db.session.commit()
+        self.assertTrue(u'slow' in fragment())
+
+    def test_facets(self):
+        db.session.add(ObjectH(title=u'first title', category=u'news'))
+        db.session.add(ObjectH(title=u'second title', category=u'news'))
+        db.session.add(ObjectH(title=u'third title', category=u'sports'))
+        db.session.add(ObjectH(title=u'fourth title'))
+        db.session.add(ObjectH(title=u'unrelated', category=u'sports'))
+        db.session.commit()
+
+        q = ObjectH.query.whoosh_search(u'title', facets=['category'])
+        self.assertEqual(q.whoosh_facets(),
+                {'category': {u'news': 2, u'sports': 1}})
+        self.assertEqual(len(list(q)), 4)
+
+        # counts cover all hits, not only the limited page
+        q = ObjectH.query.whoosh_search(u'title', limit=1,
+                facets=['category'])
+        self.assertEqual(len(list(q)), 1)
+        self.assertEqual(q.whoosh_facets(),
+                {'category': {u'news': 2, u'sports': 1}})
+
+        q = ObjectH.query.whoosh_search(u'nothing', facets=['category'])
+        self.assertEqual(q.whoosh_facets(), {'category': {}})
+
+        # facet values are not matched by text search
+        self.assertEqual(len(list(ObjectH.query.whoosh_search(u'news'))), 0)
+
+        self.assertEqual(ObjectH.query.whoosh_search(u'title').whoosh_facets(),
+                {})
+        self.assertRaises(ValueError, ObjectH.query.whoosh_search, u'title',
+                facets=['title'])
+
+    def test_init_app(self):
+        self.assertFalse(hasattr(ObjectI, 'pure_whoosh'))
+
+        self.app.config['WHOOSH_WARMUP'] = True
+        whoosh = wa.WhooshAlchemy(self.app)
+
+        self.assertTrue(self.app.extensions['whooshalchemy'] is whoosh)
+        self.assertTrue('ObjectI' in self.app.whoosh_indexes)
+        self.assertTrue('ObjectA' in self.app.whoosh_indexes)
+        self.assertFalse('BlogishBlob' in self.app.whoosh_indexes)
+        self.assertTrue('ObjectI' in self.app.whoosh_timings['warmup'])
+
+        # searchable before any commit
+        self.assertEqual(list(ObjectI.query.whoosh_search(u'title')), [])
+
+        # searches reuse the warmed searcher until the index changes
+        warmed = ObjectI.pure_whoosh.searcher
+        list(ObjectI.query.whoosh_search(u'title', facets=['title']))
+        self.assertTrue(ObjectI.pure_whoosh.searcher is warmed)
+
+        index = self.app.whoosh_indexes['ObjectI']
+        db.session.add(ObjectI(title=u'title'))
+        db.session.commit()
+        self.assertTrue(wa.whoosh_index(self.app, ObjectI) is index)
+        self.assertEqual(len(list(ObjectI.query.whoosh_search(u'title'))), 1)
+        self.assertFalse(ObjectI.pure_whoosh.searcher is warmed)
+
+    def test_stream(self):
+        from sqlalchemy import event
+
+        for i in range(7):
+            db.session.add(ObjectA(title=u' '.join([u'title'] * (i + 1))))
+        db.session.add(ObjectA(title=u'other'))
+        db.session.commit()
+
+        q = ObjectA.query.whoosh_search(u'title')
+        expected = [obj.id for obj in q]
+        self.assertEqual(len(expected), 7)
+
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            stream = q.whoosh_stream(chunk_size=3)
+            self.assertEqual(next(stream).id, expected[0])
+            self.assertEqual(len(statements), 1)
+
+            self.assertEqual([expected[0]] + [obj.id for obj in stream],
+                    expected)
+            self.assertEqual(len(statements), 3)
+
+            # each chunk binds only its own keys, not the whole result set
+            self.assertEqual([len(args[3]) for args in statements],
+                    [3, 3, 1])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        l = list(q.filter(ObjectA.id != expected[1]).whoosh_stream(2))
+        self.assertEqual([obj.id for obj in l], expected[:1] + expected[2:])
+
+        self.assertEqual(len(list(ObjectA.query.whoosh_stream(2))), 8)
+        self.assertEqual(len(list(ObjectA.query.limit(3).whoosh_stream(2))),
+                3)
+
+        # each chunk re-runs the query, which would apply these per chunk
+        self.assertRaises(ValueError, list, q.limit(4).whoosh_stream(3))
+        self.assertRaises(ValueError, list,
+                q.order_by(ObjectA.id).offset(4).whoosh_stream(3))
+
+    def test_computed_fields(self):
+        from sqlalchemy import event
+
+        alice = Author(name=u'alice')
+        bob = Author(name=u'bob')
+        db.session.add_all([alice, bob])
+        db.session.commit()
+
+        alice_id, bob_id = alice.id, bob.id
+        db.session.add(Post(title=u'first', author_id=alice_id))
+        db.session.add(Post(title=u'second', author_id=bob_id))
+        db.session.add(Post(title=u'third', author_id=alice_id))
+        db.session.commit()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+
+        posts = Post.query.all()
+        for post in posts:
+            post.tags.append(Tag(name=u'tag' + post.title))
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        # the posts, their authors and their tags: one query each
+        self.assertEqual(len(statements), 3)
+
+        def titles(query, **kwargs):
+            return sorted(p.title for p in Post.query.whoosh_search(query,
+                **kwargs))
+
+        self.assertEqual(titles(u'alice'), [u'first', u'third'])
+        self.assertEqual(titles(u'bob', fields=('author.name',)), [u'second'])
+        self.assertEqual(titles(u'tagsecond'), [u'second'])
+        self.assertEqual(titles(u'summary'), [u'first', u'second', u'third'])
+        self.assertEqual(titles(u'loudly third'), [u'third'])
+        self.assertEqual(titles(u'alice', fields=('title',)), [])
+
+        # a post without an author is still indexed
+        db.session.add(Post(title=u'anonymous'))
+        db.session.commit()
+        self.assertEqual(titles(u'anonymous'), [u'anonymous'])
+        self.assertEqual(titles(u'alice'), [u'first', u'third'])
+
+    def test_computed_field_relationships(self):
+        from sqlalchemy import event
+
+        alice = Author(name=u'alice')
+        bob = Author(name=u'bob')
+        db.session.add_all([alice, bob])
+        db.session.commit()
+        alice_id, bob_id = alice.id, bob.id
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('SELECT'):
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            db.session.add(Note(title=u'first', author_id=alice_id))
+            db.session.add(Note(title=u'second', author_id=bob_id))
+            db.session.add(Note(title=u'third', author_id=alice_id))
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        # the declared relationship is loaded along with the notes
+        self.assertEqual(len([s for s in statements if 'FROM note' in s]), 1)
+        self.assertEqual(len([s for s in statements if 'FROM author' in s]),
+                1)
+
+        def titles(query):
+            return sorted(n.title for n in Note.query.whoosh_search(query))
+
+        self.assertEqual(titles(u'alice'), [u'first', u'third'])
+
+        # undeclared relationships are lazily loaded while indexing
+        del Note.__whoosh_load__
+        try:
+            note = Note.query.filter_by(title=u'second').one()
+            note.author_id = alice_id
+            db.session.commit()
+        finally:
+            Note.__whoosh_load__ = ['author']
+
+        self.assertEqual(titles(u'alice'), [u'first', u'second', u'third'])
+        self.assertEqual(titles(u'bob'), [])
+
+    def test_partitions(self):
+        self.app.config['WHOOSH_MAX_OPEN_PARTITIONS'] = 1
+
+        db.session.add(ObjectJ(title=u'shared title', tenant_id=1))
+        db.session.add(ObjectJ(title=u'another title', tenant_id=1))
+        db.session.add(ObjectJ(title=u'shared title', tenant_id=2))
+        db.session.commit()
+
+        base = os.path.join(self.app.config['WHOOSH_BASE'], 'ObjectJ')
+        self.assertEqual(sorted(os.listdir(base)), ['1', '2'])
+
+        def search(query, partition):
+            return [(obj.tenant_id, obj.title) for obj in
+                    ObjectJ.query.whoosh_search(query, partition=partition)]
+
+        self.assertEqual(len(search(u'title', 1)), 2)
+        self.assertEqual(search(u'shared', 2), [(2, u'shared title')])
+        self.assertEqual(search(u'title', 3), [])
+        self.assertEqual(len(ObjectJ.pure_whoosh._partitions), 1)
+
+        self.assertRaises(ValueError, ObjectJ.query.whoosh_search, u'title')
+        self.assertRaises(ValueError, ObjectA.query.whoosh_search, u'title',
+                partition=1)
+
+        obj = ObjectJ.query.filter_by(tenant_id=1, title=u'another title').one()
+        db.session.delete(obj)
+        db.session.commit()
+        self.assertEqual(search(u'title', 1), [(1, u'shared title')])
+
+        # a row moved to another tenant leaves its old sub-index
+        db.session.add(ObjectJ(title=u'third title', tenant_id=1))
+        db.session.commit()
+        obj = ObjectJ.query.filter_by(tenant_id=1, title=u'shared title').one()
+        obj.tenant_id = 2
+        db.session.commit()
+        self.assertEqual(search(u'title', 1), [(1, u'third title')])
+        self.assertEqual(len(search(u'title', 2)), 2)
+        self.assertEqual(ObjectJ.pure_whoosh.partition(1)._index.doc_count(),
+                1)
+        self.assertEqual([obj.title for obj in ObjectJ.query.whoosh_search(
+            u'title', limit=1, partition=1)], [u'third title'])
+
+        # also when the column is assigned without being loaded first
+        db.session.expire(obj)
+        obj.tenant_id = 1
+        db.session.commit()
+        self.assertEqual(ObjectJ.pure_whoosh.partition(2)._index.doc_count(),
+                1)
+        self.assertEqual(len(search(u'title', 1)), 2)
+
+        # rows without a tenant are not indexed
+        db.session.add(ObjectJ(title=u'orphan title', tenant_id=None))
+        db.session.commit()
+        self.assertFalse('None' in os.listdir(base))
+        obj = ObjectJ.query.filter_by(title=u'orphan title').one()
+        db.session.delete(obj)
+        db.session.commit()
+
+    def test_timeout(self):
+        import time
+        from whoosh.scoring import FunctionWeighting
+
+        def slow_score(searcher, fieldname, text, matcher):
+            time.sleep(0.05)
+            return 1.0
+
+        self.app.config['WHOOSH_WEIGHTING'] = FunctionWeighting(slow_score)
+        for i in range(10):
+            db.session.add(ObjectA(title=u'slow title'))
+        db.session.commit()
+
+        q = ObjectA.query.whoosh_search(u'slow', fields=('title',),
+                timeout=0.1)
+        self.assertTrue(q.whoosh_partial())
+        self.assertTrue(0 < len(list(q)) < 10)
+        self.assertEqual(ObjectA.pure_whoosh.timed_out_searches, 1)
+
+        q = ObjectA.query.whoosh_search(u'slow')
+        self.assertFalse(q.whoosh_partial())
+        self.assertEqual(len(list(q)), 10)
+        self.assertEqual(ObjectA.pure_whoosh.timed_out_searches, 1)
+
+    def test_max_doc_frequency(self):
+        db.session.add(ObjectA(title=u'common rare'))
+        db.session.add(ObjectA(title=u'common'))
+        db.session.add(ObjectA(title=u'common'))
+        db.session.add(ObjectA(title=u'other'))
+        db.session.commit()
+
+        def titles(query, **kwargs):
+            return sorted(obj.title for obj in
+                    ObjectA.query.whoosh_search(query, **kwargs))
+
+        self.assertEqual(len(titles(u'common rare', or_=True)), 3)
+        self.assertEqual(titles(u'common rare', or_=True,
+            max_doc_frequency=0.5), [u'common rare'])
+
+        # only applies to OR queries, and never drops every term
+        self.assertEqual(titles(u'common rare', max_doc_frequency=0.5),
+                [u'common rare'])
+        self.assertEqual(len(titles(u'common', or_=True,
+            max_doc_frequency=0.5)), 3)
+
 
 if __name__ == '__main__':
     import unittest